@@ -1,30 +1,620 @@
+import anyio
+import asyncio
+import functools
+import importlib.util
+import logging
+import math
+import multiprocessing
 import os
+import threading
+import time
+import httpx
 import lancedb
-from lancedb.embeddings import get_registry
+import numpy as np
+import pyarrow as pa
+import xxhash
+from lancedb.embeddings import get_registry, register
+from lancedb.embeddings.sentence_transformers import SentenceTransformerEmbeddings
+from lancedb.embeddings.utils import weak_lru
 from lancedb.pydantic import LanceModel, Vector
 from mcp.server.fastmcp import FastMCP
-from typing import List, Optional, Union
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Literal, Optional, Tuple, Union
 
 
-LANCEDB_URI = os.environ.get("LANCEDB_URI", "~/lancedb")
-TABLE_NAME =  os.environ.get("TABLE_NAME", "lancedb-mcp-table")
-EMBEDDING_FUNCTION = os.environ.get("EMBEDDING_FUNCTION", "sentence-transformers")
-MODEL_NAME = os.environ.get("MODEL_NAME", "all-MiniLM-L6-v2")
+VECTOR_VALUE_TYPES = {"float32": pa.float32(), "float16": pa.float16()}
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Server settings, read from the environment once at startup."""
+
+    lancedb_uri: str
+    table_name: str
+    embedding_function: str
+    model_name: str
+    onnx_model_file: str
+    index_min_rows: int
+    index_refresh_fraction: float
+    nprobes: int
+    refine_factor: int
+    parallel_embed_min_docs: int
+    embed_processes: int
+    embed_batch_size: int
+    embed_workers: int
+    embedding_cache_size: int
+    embedding_cache_table: str
+    embedding_quant: str
+    remote_embed_url: str
+    remote_embed_batch: int
+    prewarm_indices: bool
+
+    def __post_init__(self):
+        if self.embedding_quant not in VECTOR_VALUE_TYPES:
+            raise ValueError(
+                f"EMBEDDING_QUANT must be one of {sorted(VECTOR_VALUE_TYPES)}, "
+                f"got {self.embedding_quant!r}"
+            )
+        for env_var, value in (
+            ("LANCEDB_EMBED_BATCH", self.embed_batch_size),
+            ("LANCEDB_EMBED_WORKERS", self.embed_workers),
+            ("EMBED_PROCESSES", self.embed_processes),
+            ("REMOTE_EMBED_BATCH", self.remote_embed_batch),
+        ):
+            if value < 1:
+                raise ValueError(f"{env_var} must be at least 1, got {value}")
+
+    @property
+    def vector_value_type(self) -> pa.DataType:
+        """Arrow type of the values stored in the vector column."""
+        return VECTOR_VALUE_TYPES[self.embedding_quant]
+
+    @classmethod
+    def from_env(cls):
+        env = os.environ
+        return cls(
+            lancedb_uri=env.get("LANCEDB_URI", "~/lancedb"),
+            table_name=env.get("TABLE_NAME", "lancedb-mcp-table"),
+            embedding_function=env.get("EMBEDDING_FUNCTION", "sentence-transformers"),
+            model_name=env.get("MODEL_NAME", "all-MiniLM-L6-v2"),
+            onnx_model_file=env.get("ONNX_MODEL_FILE", "onnx/model_qint8_avx512_vnni.onnx"),
+            index_min_rows=int(env.get("INDEX_MIN_ROWS", 256 * 256)),
+            index_refresh_fraction=float(env.get("INDEX_REFRESH_FRACTION", 0.1)),
+            nprobes=int(env.get("LANCEDB_NPROBES", 20)),
+            refine_factor=int(env.get("LANCEDB_REFINE_FACTOR", 10)),
+            parallel_embed_min_docs=int(env.get("PARALLEL_EMBED_MIN_DOCS", 1024)),
+            embed_processes=int(env.get("EMBED_PROCESSES", min(4, os.cpu_count() or 1))),
+            embed_batch_size=int(env.get("LANCEDB_EMBED_BATCH", 32)),
+            embed_workers=int(env.get("LANCEDB_EMBED_WORKERS", 1)),
+            embedding_cache_size=int(env.get("EMBEDDING_CACHE_SIZE", 10_000)),
+            embedding_cache_table=env.get("EMBEDDING_CACHE_TABLE", "__embedding_cache"),
+            embedding_quant=env.get("EMBEDDING_QUANT", "float32"),
+            remote_embed_url=env.get("REMOTE_EMBED_URL", ""),
+            remote_embed_batch=int(env.get("REMOTE_EMBED_BATCH", 256)),
+            prewarm_indices=env.get("PREWARM_INDICES", "").lower() in ("1", "true", "yes"),
+        )
+
+
+CONFIG = Config.from_env()
+
+METRIC = "cosine"
+STORE_LOOKUP_BATCH = 1000
+
+logger = logging.getLogger(__name__)
 
-model = get_registry().get(EMBEDDING_FUNCTION).create(name=MODEL_NAME)
 mcp = FastMCP("lancedb")
 
-class Schema(LanceModel):
-    doc: str = model.SourceField()
-    vector: Vector(model.ndims()) = model.VectorField()
+
+@functools.lru_cache(maxsize=1)
+def get_connection():
+    """Return the process-wide LanceDB connection."""
+    return lancedb.connect(CONFIG.lancedb_uri)
+
+
+@functools.lru_cache(maxsize=32)
+def get_table_cached(table_name: str):
+    """Return a cached handle to an existing table, keyed on its name."""
+    return get_connection().open_table(table_name)
+
+
+@register("onnx-st")
+class OnnxSentenceTransformerEmbeddings(SentenceTransformerEmbeddings):
+    """
+    Sentence-transformers model served through ONNX Runtime.
+
+    Defaults to the int8 dynamically-quantized export published alongside the
+    sentence-transformers models. Select it with EMBEDDING_FUNCTION=onnx-st;
+    requires the ``onnx`` extra.
+    """
+
+    file_name: str = CONFIG.onnx_model_file
+
+    @weak_lru(maxsize=1)
+    def get_embedding_model(self):
+        from sentence_transformers import SentenceTransformer
+
+        return SentenceTransformer(
+            self.name,
+            device=self.device,
+            backend="onnx",
+            model_kwargs={"file_name": self.file_name},
+        )
+
+
+@functools.lru_cache(maxsize=1)
+def get_model():
+    """Load the embedding model on first use so metadata-only calls never pay for it."""
+    return get_registry().get(CONFIG.embedding_function).create(name=CONFIG.model_name)
+
+
+@functools.cache
+def get_schema():
+    """Build the table schema, which needs the model's vector dimensions."""
+    model = get_model()
+
+    class Schema(LanceModel):
+        doc: str = model.SourceField()
+        vector: Vector(model.ndims(), value_type=CONFIG.vector_value_type) = model.VectorField()
+
+    return Schema
+
+
+def embedding_ndims() -> int:
+    """
+    Width of the embedding vectors.
+
+    With REMOTE_EMBED_URL set it is read from the existing table's vector
+    column, so remote-only ingests don't load the local model just for this.
+    """
+    if CONFIG.remote_embed_url:
+        try:
+            return get_table_cached(CONFIG.table_name).schema.field("vector").type.list_size
+        except (FileNotFoundError, ValueError):
+            pass
+    return get_model().ndims()
+
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU cache of document embeddings keyed on a hash of the text.
+
+    Vectors are kept as rows of one float32 matrix, grown on demand up to
+    ``capacity`` rows; the OrderedDict only maps keys to row numbers.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._rows: "OrderedDict[int, int]" = OrderedDict()
+        self._vectors: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def lookup(self, keys: List[int], out: np.ndarray) -> List[int]:
+        """Copy cached vectors into the matching rows of ``out``; return the positions that missed."""
+        misses = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                row = self._rows.get(key)
+                if row is None:
+                    misses.append(i)
+                else:
+                    self._rows.move_to_end(key)
+                    out[i] = self._vectors[row]
+        return misses
+
+    def store(self, keys: List[int], vectors: np.ndarray):
+        """Insert vectors, evicting the least recently used entries once full."""
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                if key in self._rows:
+                    self._rows.move_to_end(key)
+                    continue
+                if len(self._rows) < self.capacity:
+                    row = len(self._rows)
+                    self._reserve(row + 1, vector.shape[0])
+                else:
+                    _, row = self._rows.popitem(last=False)
+                self._rows[key] = row
+                self._vectors[row] = vector
+
+    def _reserve(self, size: int, ndims: int):
+        if self._vectors is None:
+            self._vectors = np.empty((min(1024, self.capacity), ndims), dtype=np.float32)
+        if size > len(self._vectors):
+            grown = np.empty((min(self.capacity, 2 * len(self._vectors)), ndims), dtype=np.float32)
+            grown[:len(self._vectors)] = self._vectors
+            self._vectors = grown
+
+
+embedding_cache = EmbeddingCache(CONFIG.embedding_cache_size)
+
+EMBEDDING_CACHE_SCHEMA = pa.schema([
+    pa.field("model", pa.string()),
+    pa.field("key", pa.string()),
+    pa.field("vector", pa.list_(pa.float32())),
+])
+
+
+def find_index(table, column: str):
+    """Return the config of ``table``'s index on ``column``, or None."""
+    return next((index for index in table.list_indices() if index.columns == [column]), None)
+
+
+def refresh_index(table, index, num_rows: int):
+    """
+    Run ``table.optimize()`` once more than CONFIG.index_refresh_fraction of its rows are missing from ``index``.
+
+    optimize() adds the new rows to the existing indices and compacts small
+    fragments, so searches don't drift back to flat scans as data is appended.
+    """
+    stats = table.index_stats(index.name)
+    if stats is not None and stats.num_unindexed_rows > CONFIG.index_refresh_fraction * num_rows:
+        table.optimize()
+
+
+@functools.lru_cache(maxsize=1)
+def get_embedding_store():
+    """Open (or create) the table that persists embeddings across restarts."""
+    return get_connection().create_table(
+        CONFIG.embedding_cache_table, schema=EMBEDDING_CACHE_SCHEMA, exist_ok=True
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def model_identity() -> str:
+    """Identify the embedding model, so persisted vectors are never reused across models."""
+    return f"{CONFIG.embedding_function}/{CONFIG.model_name}/{embedding_ndims()}"
+
+
+def load_stored_embeddings(keys: List[int]) -> dict:
+    """
+    Fetch persisted vectors for ``keys`` as ``{key: vector}``; missing keys are absent.
+
+    The store is moved to its latest version first, so entries written by
+    other server processes are seen. Keys are looked up STORE_LOOKUP_BATCH at
+    a time to keep each ``IN`` predicate small. Concurrent ingests can store
+    the same key twice, so no row limit is applied and duplicates collapse
+    into one entry.
+    """
+    store = get_embedding_store()
+    store.checkout_latest()
+    model = model_identity().replace("'", "''")
+    stored = {}
+    for _, chunk in iter_chunks(keys, STORE_LOOKUP_BATCH):
+        hex_keys = ", ".join(f"'{key:032x}'" for key in chunk)
+        found = (
+            store.search()
+            .where(f"model = '{model}' AND key IN ({hex_keys})")
+            .select(["key", "vector"])
+            .limit(None)
+            .to_arrow()
+        )
+        stored.update(
+            (int(key, 16), vector)
+            for key, vector in zip(found["key"].to_pylist(), found["vector"].to_pylist())
+        )
+    return stored
+
+
+def save_embeddings(keys: List[int], vectors: np.ndarray):
+    """
+    Persist freshly computed vectors for later processes.
+
+    A BTREE index on ``key`` is built after the first write, and refreshed
+    as rows are added, so lookups don't scan the whole table as it grows.
+    """
+    num_rows, ndims = vectors.shape
+    offsets = pa.array(np.arange(0, (num_rows + 1) * ndims, ndims, dtype=np.int32))
+    store = get_embedding_store()
+    store.add(pa.table({
+        "model": pa.array([model_identity()] * num_rows, type=pa.string()),
+        "key": pa.array([f"{key:032x}" for key in keys], type=pa.string()),
+        "vector": pa.ListArray.from_arrays(offsets, pa.array(vectors.reshape(-1))),
+    }, schema=EMBEDDING_CACHE_SCHEMA))
+    index = find_index(store, "key")
+    if index is None:
+        store.create_scalar_index("key", index_type="BTREE")
+    else:
+        refresh_index(store, index, store.count_rows())
+
+
+def iter_chunks(items: List, size: int):
+    """Yield ``(start, chunk)`` pairs of at most ``size`` consecutive items."""
+    for start in range(0, len(items), size):
+        yield start, items[start:start + size]
+
+
+def compute_embeddings(docs: List[str]) -> np.ndarray:
+    """
+    Run the model on ``docs`` in CONFIG.embed_batch_size chunks, bounding peak memory.
+
+    Module-level so spawned worker processes can call it.
+    """
+    model = get_model()
+    vectors = np.empty((len(docs), model.ndims()), dtype=np.float32)
+    for start, chunk in iter_chunks(docs, CONFIG.embed_batch_size):
+        began = time.perf_counter()
+        vectors[start:start + len(chunk)] = model.compute_source_embeddings(chunk)
+        logger.debug("Embedded %d docs in %.1f ms", len(chunk), (time.perf_counter() - began) * 1000)
+    return vectors
+
+
+def limit_torch_threads(workers: int):
+    """Give torch an equal share of the CPU cores for each of ``workers`` concurrent embedders."""
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+
+@functools.lru_cache(maxsize=1)
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Worker processes for large ingests, kept alive so each loads the model once.
+
+    Uses the spawn start method: forking a process that has LanceDB's
+    thread pools running is unsafe. Each worker caps torch's intra-op threads
+    so the pool doesn't oversubscribe the cores.
+    """
+    return ProcessPoolExecutor(
+        max_workers=CONFIG.embed_processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=limit_torch_threads,
+        initargs=(CONFIG.embed_processes,),
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_thread_pool() -> ThreadPoolExecutor:
+    """Threads that embed batches of a single ingest concurrently, if LANCEDB_EMBED_WORKERS > 1."""
+    return ThreadPoolExecutor(max_workers=CONFIG.embed_workers, thread_name_prefix="embed")
+
+
+def compute_embeddings_threaded(docs: List[str]) -> np.ndarray:
+    """Embed CONFIG.embed_batch_size chunks of ``docs`` concurrently on the thread pool, keeping order."""
+    chunks = [chunk for _, chunk in iter_chunks(docs, CONFIG.embed_batch_size)]
+    return np.concatenate(list(get_thread_pool().map(compute_embeddings, chunks)))
+
+
+def compute_embeddings_parallel(docs: List[str]) -> np.ndarray:
+    """Shard ``docs`` across the process pool and reassemble the vectors in order."""
+    shard_size = math.ceil(len(docs) / CONFIG.embed_processes)
+    shards = [docs[i:i + shard_size] for i in range(0, len(docs), shard_size)]
+    return np.concatenate(list(get_process_pool().map(compute_embeddings, shards)))
+
+
+@functools.lru_cache(maxsize=1)
+def get_http_client() -> httpx.Client:
+    """Shared HTTP client, so remote embedding calls reuse pooled connections."""
+    return httpx.Client(timeout=30.0)
+
+
+def compute_embeddings_remote(docs: List[str]) -> np.ndarray:
+    """
+    Embed ``docs`` on the CONFIG.remote_embed_url inference service.
+
+    The service receives ``{"model": ..., "texts": [...]}`` and answers with
+    ``{"embeddings": [[...], ...]}`` in the same order. It can batch requests
+    from many clients onto a GPU. Docs are sent CONFIG.remote_embed_batch at a time,
+    and a response of the wrong shape raises ValueError.
+    """
+    ndims = embedding_ndims()
+    vectors = np.empty((len(docs), ndims), dtype=np.float32)
+    for start, chunk in iter_chunks(docs, CONFIG.remote_embed_batch):
+        response = get_http_client().post(CONFIG.remote_embed_url, json={"model": CONFIG.model_name, "texts": chunk})
+        response.raise_for_status()
+        embeddings = np.asarray(response.json()["embeddings"], dtype=np.float32)
+        if embeddings.shape != (len(chunk), ndims):
+            raise ValueError(
+                f"remote embeddings have shape {embeddings.shape}, expected {(len(chunk), ndims)}"
+            )
+        vectors[start:start + len(chunk)] = embeddings
+    return vectors
+
+
+def compute_missing(docs: List[str]) -> Tuple[np.ndarray, bool]:
+    """
+    Run the model on ``docs``, none of which are cached.
+
+    Tries CONFIG.remote_embed_url first if set. Locally, large sets fan out to worker
+    processes, mid-sized ones to CONFIG.embed_workers threads, and the rest run in
+    one call. Also returns whether the vectors came from the local model,
+    the only one model_identity() describes.
+    """
+    if CONFIG.remote_embed_url:
+        try:
+            return compute_embeddings_remote(docs), False
+        except (httpx.HTTPError, KeyError, TypeError, ValueError) as exc:
+            logger.warning("Remote embedding failed, embedding locally: %s", exc)
+    if len(docs) >= CONFIG.parallel_embed_min_docs and CONFIG.embed_processes > 1:
+        return compute_embeddings_parallel(docs), True
+    if len(docs) > CONFIG.embed_batch_size and CONFIG.embed_workers > 1:
+        return compute_embeddings_threaded(docs), True
+    return compute_embeddings(docs), True
+
+
+def embed_distinct(docs: List[str], keys: List[int]) -> np.ndarray:
+    """
+    Embed distinct ``docs`` (with their hash ``keys``), only running the model on uncached texts.
+
+    Lookups go to the in-memory cache first, then to the persistent
+    CONFIG.embedding_cache_table; newly computed vectors are written to both, except
+    that remote vectors are not persisted. Only the misses are handed to
+    compute_missing, which may split them across workers.
+    """
+    vectors = np.empty((len(docs), embedding_ndims()), dtype=np.float32)
+    misses = embedding_cache.lookup(keys, vectors)
+    if misses and CONFIG.embedding_cache_table:
+        stored = load_stored_embeddings([keys[i] for i in misses])
+        if stored:
+            hits = [i for i in misses if keys[i] in stored]
+            vectors[hits] = [stored[keys[i]] for i in hits]
+            embedding_cache.store([keys[i] for i in hits], vectors[hits])
+            misses = [i for i in misses if keys[i] not in stored]
+    if misses:
+        computed, local = compute_missing([docs[i] for i in misses])
+        vectors[misses] = computed
+        miss_keys = [keys[i] for i in misses]
+        embedding_cache.store(miss_keys, computed)
+        if CONFIG.embedding_cache_table and local:
+            save_embeddings(miss_keys, computed)
+    return vectors
+
+
+def dedupe_docs(docs: List[str]) -> Tuple[List[str], List[int], List[int]]:
+    """
+    Collapse repeated texts into ``(distinct_docs, keys, inverse)``.
+
+    ``keys`` are the hashes of ``distinct_docs`` and ``docs[i] == distinct_docs[inverse[i]]``,
+    so indexing per-distinct results with ``inverse`` restores input order.
+
+    >>> distinct_docs, keys, inverse = dedupe_docs(["a", "b", "a", "c", "b"])
+    >>> distinct_docs, inverse
+    (['a', 'b', 'c'], [0, 1, 0, 2, 1])
+    >>> np.array([[0.0], [1.0], [2.0]])[inverse].ravel().tolist()
+    [0.0, 1.0, 0.0, 2.0, 1.0]
+    """
+    slots = {}
+    distinct_docs, distinct_keys, inverse = [], [], []
+    for doc in docs:
+        key = xxhash.xxh3_128_intdigest(doc.encode())
+        slot = slots.get(key)
+        if slot is None:
+            slot = slots[key] = len(distinct_docs)
+            distinct_docs.append(doc)
+            distinct_keys.append(key)
+        inverse.append(slot)
+    return distinct_docs, distinct_keys, inverse
+
+
+def get_embeddings(docs: List[str]) -> np.ndarray:
+    """Embed ``docs`` as an (N, ndims) float32 array; repeated texts are embedded once."""
+    distinct_docs, distinct_keys, inverse = dedupe_docs(docs)
+    vectors = embed_distinct(distinct_docs, distinct_keys)
+    if len(distinct_docs) == len(docs):
+        return vectors
+    return vectors[inverse]
+
+
+def to_record_batch(docs: List[str], vectors: np.ndarray, schema: pa.Schema) -> pa.RecordBatch:
+    """Build a columnar batch matching the table ``schema`` from docs and their precomputed vectors."""
+    vector_type = schema.field("vector").type
+    values = vectors.reshape(-1).astype(vector_type.value_type.to_pandas_dtype(), copy=False)
+    vector_array = pa.FixedSizeListArray.from_arrays(
+        pa.array(values, type=vector_type.value_type), vector_type.list_size
+    )
+    return pa.RecordBatch.from_arrays(
+        [pa.array(docs, type=pa.string()), vector_array],
+        schema=schema,
+    )
+
+
+async def embed_docs(docs: List[str]) -> np.ndarray:
+    """
+    Embed ``docs`` off the event loop, keeping input order.
+
+    Hashing, de-duplication and cache lookups run once for the whole ingest;
+    only the distinct uncached docs are split across threads or processes.
+    """
+    return await asyncio.to_thread(get_embeddings, docs)
+
+
+def get_or_create_table():
+    """Open the configured table, creating it from the schema on first ingest."""
+    try:
+        return get_table_cached(CONFIG.table_name)
+    except (FileNotFoundError, ValueError):
+        # LanceDB raises one of these for a missing table, depending on version.
+        pass
+    table = get_connection().create_table(CONFIG.table_name, schema=get_schema(), exist_ok=True)
+    get_table_cached.cache_clear()
+    return table
+
+
+row_counts: dict = {}
+
+
+def count_rows_cached(table) -> int:
+    """
+    Row count of ``table`` at its current version, reused until the version changes.
+
+    The version is read before and after counting, and the count is only
+    cached if they match, so a concurrent ingest can't file a new count under
+    an old version.
+    """
+    version = table.version
+    cached = row_counts.get(table.name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    num_rows = table.count_rows()
+    if table.version == version:
+        row_counts[table.name] = (version, num_rows)
+    return num_rows
+
+
+def maybe_create_index(table):
+    """
+    Build an IVF_PQ index on the vector column once the table is big enough to benefit.
+
+    Later ingests refresh the existing index instead of rebuilding it.
+    """
+    num_rows = table.count_rows()
+    if num_rows < CONFIG.index_min_rows:
+        return
+    index = find_index(table, "vector")
+    if index is not None:
+        refresh_index(table, index, num_rows)
+        return
+
+    ndims = table.schema.field("vector").type.list_size
+    table.create_index(
+        metric=METRIC,
+        num_partitions=int(math.sqrt(num_rows)),
+        num_sub_vectors=ndims // 16 if ndims % 16 == 0 else None,
+        vector_column_name="vector",
+        index_type="IVF_PQ",
+    )
+
+
+def upsert_docs(table, batch: pa.RecordBatch):
+    """
+    Insert docs that aren't in the table yet and overwrite the ones that are.
+
+    Overwriting refreshes stored vectors, e.g. after a model change. ``batch``
+    must not repeat a doc. merge_insert has to look up every incoming doc
+    among the existing rows, so a BTREE index on ``doc`` is built first and
+    refreshed as rows are added. Plain appends should use ``table.add()``,
+    which is much cheaper.
+    """
+    num_rows = table.count_rows()
+    index = find_index(table, "doc")
+    if index is None and num_rows > 0:
+        table.create_scalar_index("doc", index_type="BTREE")
+    elif index is not None:
+        refresh_index(table, index, num_rows)
+    (
+        table.merge_insert("doc")
+        .when_matched_update_all()
+        .when_not_matched_insert_all()
+        .execute(batch)
+    )
+
 
 @mcp.tool()
-def ingest_docs(docs: Union[str, List[str]]):
+async def ingest_docs(docs: Union[str, List[str]],
+                      mode: Literal["append", "upsert"] = "append"):
     """
     Ingests a list of documents into a LanceDB table. It is critical that the metdata must be a string literal
 
     Args:
         docs (Union[str, List[str]]): A string or a list of strings to ingest.
+        mode (str): "append" (default) adds every doc as a new row. "upsert" replaces docs
+            that are already stored and ingests repeats in ``docs`` once; it is slower
+            because existing rows must be matched.
 
     Returns:
         None
@@ -37,27 +627,93 @@ def ingest_docs(docs: Union[str, List[str]]):
 
     if isinstance(docs, str):
         docs = [docs]
-    
-    db = lancedb.connect(LANCEDB_URI)
-    if TABLE_NAME in db.table_names():
-        table = db.open_table(TABLE_NAME)
-    else:
-        table = db.create_table(TABLE_NAME, schema=Schema)
+    if mode == "upsert":
+        docs = list(dict.fromkeys(docs))
+    if not docs:
+        return "No documents to ingest"
 
-    table_data = [
-        {
-            "doc": doc,
-        }
-        for doc in docs
-    ]
-    table.add(table_data)
+    table = await asyncio.to_thread(get_or_create_table)
+    vectors = await embed_docs(docs)
+    batch = to_record_batch(docs, vectors, table.schema)
+    if mode == "upsert":
+        await asyncio.to_thread(upsert_docs, table, batch)
+    else:
+        await asyncio.to_thread(table.add, batch)
+    await asyncio.to_thread(maybe_create_index, table)
 
     return "Data added to lancedb successfully"
 
+
+def open_latest_table(table_name: str):
+    """Return the cached handle for ``table_name``, moved to the newest table version."""
+    table = get_table_cached(table_name)
+    table.checkout_latest()
+    return table
+
+
+query_cache = EmbeddingCache(1024)
+
+
+def embed_queries(queries: List[str], dtype: np.dtype = np.dtype(np.float32)) -> np.ndarray:
+    """
+    Embed search queries as rows of ``dtype``, the value type of the searched vector column.
+
+    Queries are whitespace-normalized and looked up in ``query_cache``; the
+    distinct misses go to the model's query-embedding path in one call.
+    """
+    normalized = [" ".join(query.split()) for query in queries]
+    keys = [xxhash.xxh3_128_intdigest(query.encode()) for query in normalized]
+    vectors = np.empty((len(queries), get_model().ndims()), dtype=np.float32)
+    misses = query_cache.lookup(keys, vectors)
+    if misses:
+        distinct = {keys[i]: normalized[i] for i in misses}
+        computed = np.asarray(
+            get_model().compute_query_embeddings(list(distinct.values())), dtype=np.float32
+        )
+        rows = {key: row for row, key in enumerate(distinct)}
+        vectors[misses] = computed[[rows[keys[i]] for i in misses]]
+        query_cache.store(list(distinct), computed)
+    return vectors.astype(dtype, copy=False)
+
+
+def embed_query(query: str, dtype: np.dtype = np.dtype(np.float32)) -> np.ndarray:
+    """Embed a single search query as ``dtype``; see embed_queries."""
+    return embed_queries([query], dtype)[0]
+
+
+def vector_dtype(table) -> np.dtype:
+    """NumPy dtype of the values in ``table``'s vector column."""
+    return np.dtype(table.schema.field("vector").type.value_type.to_pandas_dtype())
+
+
+def search_vector(table, query_vector: np.ndarray, top_k: int,
+                  distance_threshold: Optional[float] = None):
+    """Return the ``top_k`` docs nearest to ``query_vector``."""
+    search = (
+        table.search(query_vector, query_type="vector")
+        .distance_type(METRIC)
+        .select(["doc"])
+        .limit(top_k)
+        .nprobes(CONFIG.nprobes)
+        .refine_factor(CONFIG.refine_factor)
+    )
+    if distance_threshold is not None:
+        search = search.distance_range(upper_bound=distance_threshold)
+    return search.to_list()
+
+
+def search_table(query: str, top_k: int, distance_threshold: Optional[float] = None):
+    """Run a vector search for ``query`` against the configured table."""
+    table = open_latest_table(CONFIG.table_name)
+    query_vector = embed_query(query, vector_dtype(table))
+    return search_vector(table, query_vector, top_k, distance_threshold)
+
+
 @mcp.tool()
-def query_table(query: str,
+async def query_table(query: str,
                 top_k: int = 5,
-                query_type: str = "vector"): # TODO: add support for advanced query types
+                query_type: str = "vector", # TODO: add support for advanced query types
+                distance_threshold: Optional[float] = None):
     """
     Query a LanceDB table with a query string and return the top k results.
 
@@ -66,21 +722,54 @@ def query_table(query: str,
         query (str): The query string.
         top_k (int): The number of results to return. Defaults to 5.
         query_type (str): The type of query to perform. Defaults to "vector".
+        distance_threshold (float): Only return results whose cosine distance to the
+            query is below this value. Defaults to no limit.
 
     Returns:
 
         List[Schema]: A list of Schema objects.
     """
-    db = lancedb.connect(LANCEDB_URI)
-    table = db.open_table(TABLE_NAME)
-    results = table.search(query, query_type="vector") # TODO 
-    results = results.limit(top_k).select(["doc"]).to_list()
+    return await asyncio.to_thread(search_table, query, top_k, distance_threshold)
+
+
+@mcp.tool()
+async def query_table_batch(queries: List[str],
+                            top_k: int = 5,
+                            distance_threshold: Optional[float] = None):
+    """
+    Run several queries against a LanceDB table at once, e.g. the parts of a decomposed question.
+
+    Uncached queries are embedded in a single model call and the searches run concurrently.
+
+    Args:
 
-    return results
+        queries (List[str]): The query strings.
+        top_k (int): The number of results to return per query. Defaults to 5.
+        distance_threshold (float): Only return results whose cosine distance to the
+            query is below this value. Defaults to no limit.
+
+    Returns:
+
+        List[List[Schema]]: One result list per query, in the order of ``queries``.
+    """
+    if not queries:
+        return []
+    table = await asyncio.to_thread(open_latest_table, CONFIG.table_name)
+    vectors = await asyncio.to_thread(embed_queries, queries, vector_dtype(table))
+    return list(await asyncio.gather(*(
+        asyncio.to_thread(search_vector, table, vector, top_k, distance_threshold)
+        for vector in vectors
+    )))
+
+
+@functools.lru_cache(maxsize=32)
+def summarize_schema(schema: pa.Schema) -> dict:
+    """Render a schema as ``{column: type}`` strings, once per distinct schema."""
+    return {field.name: str(field.type) for field in schema}
 
 
 @mcp.tool()
-def table_details(
+async def table_details(
     table_name: Optional[str] = None,
     db_uri: Optional[str] = None,
 ):
@@ -95,13 +784,49 @@ def table_details(
     Returns:
         dict: A dictionary of the table details.
     """
-    db = lancedb.connect(LANCEDB_URI)
-    table = db.open_table(TABLE_NAME)
+    table = await asyncio.to_thread(open_latest_table, CONFIG.table_name)
+    num_rows, schema = await asyncio.gather(
+        asyncio.to_thread(count_rows_cached, table),
+        asyncio.to_thread(lambda: summarize_schema(table.schema)),
+    )
     return {
         "name": table_name,
-        "num_rows": len(table),
-        "Schema": table.schema,
+        "num_rows": num_rows,
+        "Schema": schema,
     }
 
+
+def prewarm_table():
+    """
+    Run a one-row search against the configured table's vector index.
+
+    This makes LanceDB read the IVF centroids and PQ codebooks at startup, so
+    the first real query doesn't pay for those cold reads. The probe is a
+    non-zero vector searched with METRIC, like the tools' own queries; a zero
+    vector has no cosine direction. A missing or unindexed table is skipped,
+    since a search on it would be a full scan.
+    """
+    try:
+        table = get_table_cached(CONFIG.table_name)
+    except (FileNotFoundError, ValueError):
+        return
+    if find_index(table, "vector") is None:
+        return
+    vector_type = table.schema.field("vector").type
+    probe = np.ones(vector_type.list_size, dtype=vector_type.value_type.to_pandas_dtype())
+    (
+        table.search(probe, vector_column_name="vector")
+        .distance_type(METRIC)
+        .nprobes(1)
+        .limit(1)
+        .to_arrow()
+    )
+
+
 if __name__ == "__main__":
-    mcp.run()
+    if CONFIG.prewarm_indices:
+        prewarm_table()
+    if importlib.util.find_spec("uvloop") is None:
+        mcp.run()
+    else:
+        anyio.run(mcp.run_stdio_async, backend_options={"use_uvloop": True})